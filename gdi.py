@@ -5,12 +5,100 @@ import numpy as np
 import scipy.constants as pc
 import ti
 
+from concurrent.futures import ThreadPoolExecutor
 from scipy.integrate import solve_ivp
 from lib.utils import create_path
 from lib.utils import block_avg
 from lib.lammps import get_natoms
 from lib.RemoteJob import SSHSession, JobStatus, SlurmJob
 
+# abspath of dpdt.out -> ((st_mtime_ns, st_size), parsed records, sorted index)
+_DPDT_CACHE = {}
+
+# dpdt.out stores float64 records (temp, pres, dv, dh) in raw binary.
+# databases written by older versions are plain text and migrated on load.
+_DPDT_TEXT_BYTES = set(b'0123456789.eE+- \t\r\nnNaAiIfFtTyY')
+_DPDT_RECORD_BYTES = 4 * np.dtype(np.float64).itemsize
+
+def _is_text_dpdt(path) :
+    with open(path, 'rb') as fp :
+        head = fp.read(64)
+    return len(head) > 0 and set(head) <= _DPDT_TEXT_BYTES
+
+def _migrate_dpdt(path) :
+    data = np.reshape(np.loadtxt(path), [-1,4])
+    tmp_path = path + '.tmp'
+    data.astype(np.float64).tofile(tmp_path)
+    os.replace(tmp_path, path)
+
+def _dpdt_stat_key(path) :
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def _load_dpdt(path) :
+    path = os.path.abspath(path)
+    stat_key = _dpdt_stat_key(path)
+    if path not in _DPDT_CACHE and _is_text_dpdt(path) :
+        _migrate_dpdt(path)
+        stat_key = _dpdt_stat_key(path)
+    if path in _DPDT_CACHE and _DPDT_CACHE[path][0] == stat_key :
+        return _DPDT_CACHE[path][1], _DPDT_CACHE[path][2]
+    if stat_key[1] % _DPDT_RECORD_BYTES != 0 :
+        raise RuntimeError("the size of %s is not a multiple of the %d bytes record, the database is corrupted"
+                           % (path, _DPDT_RECORD_BYTES))
+    data = np.reshape(np.fromfile(path, dtype=np.float64), [-1,4])
+    # (sorted values, permutation) of the temp and the pres columns
+    index = []
+    for col in [0, 1] :
+        perm = np.argsort(data[:,col], kind = 'stable')
+        index.append((data[perm,col], perm))
+    _DPDT_CACHE[path] = (stat_key, data, index)
+    return data, index
+
+def _append_dpdt(path, temp, pres, dv, dh) :
+    # one unbuffered O_APPEND write per record, synced before the next
+    # load so the (mtime, size) key of the cache always sees it
+    path = os.path.abspath(path)
+    record = np.hstack([temp, pres, dv, dh]).astype(np.float64)
+    cached = _DPDT_CACHE.get(path)
+    if cached is not None and \
+       (not os.path.isfile(path) or _dpdt_stat_key(path) != cached[0]) :
+        cached = None
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_CLOEXEC', 0), 0o644)
+    try :
+        os.write(fd, record.tobytes())
+        os.fsync(fd)
+    finally :
+        os.close(fd)
+    if cached is None :
+        return
+    # insert the new row into the cached records and the sorted index,
+    # so the next load does not re-read and re-sort the whole database
+    stat_key, data, index = cached
+    data = np.vstack([data, record])
+    new_index = []
+    for col, (sorted_vals, perm) in zip([0, 1], index) :
+        # side right: keep equal values in row order, as the stable argsort does
+        pos = np.searchsorted(sorted_vals, record[col], side = 'right')
+        new_index.append((np.insert(sorted_vals, pos, record[col]),
+                          np.insert(perm, pos, data.shape[0] - 1)))
+    _DPDT_CACHE[path] = (_dpdt_stat_key(path), data, new_index)
+
+def _nearest_record(sorted_vals, perm, target) :
+    target = np.asarray(target).item()
+    idx = int(np.searchsorted(sorted_vals, target))
+    # searchsorted gives the first of equal values, i.e. the lowest row
+    if idx == sorted_vals.size :
+        idx = int(np.searchsorted(sorted_vals, sorted_vals[-1]))
+    elif idx > 0 :
+        left = int(np.searchsorted(sorted_vals, sorted_vals[idx-1]))
+        dl = target - sorted_vals[left]
+        dr = sorted_vals[idx] - target
+        # on a tie take the earlier row, as argmin does
+        if dl < dr or (dl == dr and perm[left] < perm[idx]) :
+            idx = left
+    return int(perm[idx])
+
 def _group_slurm_jobs(ssh_sess,
                       resources,
                       command,
@@ -25,26 +113,54 @@ def _group_slurm_jobs(ssh_sess,
         [os.path.basename(j) for j in tasks[i:i + group_size]] \
         for i in range(0, len(tasks), group_size)
     ]
-    job_list = []
-    for chunk in task_chunks :
-        rjob = remote_job(ssh_sess, work_path)
-        rjob.upload('.',  forward_common_files)
-        rjob.upload(chunk, forward_task_files)
+    job_list = [remote_job(ssh_sess, work_path) for chunk in task_chunks]
+    # the common files are staged once per ssh session and linked into every task
+    common_links = {}
+    for ii in forward_common_files :
+        common_links[os.path.basename(ii)] = ssh_sess.stage_file(os.path.join(work_path, ii))
+    # each upload streams over its own ssh channel, so they can overlap.
+    # job creation and submission use the shared sftp channel and stay serial
+    def _upload_one(rjob, chunk) :
+        rjob.upload_bulk(chunk, forward_task_files, linked_files = common_links)
+    with ThreadPoolExecutor(max_workers = max(1, min(8, len(task_chunks)))) as executor :
+        list(executor.map(_upload_one, job_list, task_chunks))
+    for rjob, chunk in zip(job_list, task_chunks) :
         rjob.submit(chunk, command, resources = resources)
-        job_list.append(rjob)
 
     job_fin = [False for ii in job_list]
+    job_stat = [None for ii in job_list]
+    # poll quickly at first and back off to the max interval,
+    # restart from the min interval whenever a job changes its state
+    poll_min = 1.0
+    poll_max = 30.0
+    poll = poll_min
     while not all(job_fin) :
+        changed = False
+        if hasattr(remote_job, 'check_status_batch') :
+            batch_stat = remote_job.check_status_batch(
+                ssh_sess,
+                [rjob for idx,rjob in enumerate(job_list) if not job_fin[idx]])
         for idx,rjob in enumerate(job_list) :
             if not job_fin[idx] :
-                status = rjob.check_status()
+                if hasattr(remote_job, 'check_status_batch') :
+                    status = batch_stat[rjob._get_job_id()]
+                else :
+                    status = rjob.check_status()
+                if status != job_stat[idx] :
+                    job_stat[idx] = status
+                    changed = True
                 if status == JobStatus.terminated :
                     raise RuntimeError("find unsuccessfully terminated job in %s" % rjob.get_job_root())
                 elif status == JobStatus.finished :
-                    rjob.download(task_chunks[idx], backward_task_files)
+                    rjob.download_bulk(task_chunks[idx], backward_task_files)
                     rjob.clean()
                     job_fin[idx] = True
-        time.sleep(30)
+        if all(job_fin) :
+            break
+        if changed :
+            poll = poll_min
+        time.sleep(poll)
+        poll = min(poll * 1.5, poll_max)
 
 def _make_tasks_onephase(temp, 
                          pres, 
@@ -52,11 +168,9 @@ def _make_tasks_onephase(temp,
                          jdata, 
                          conf_file = 'conf.lmp', 
                          graph_file = 'graph.pb') :
-    # assume that model and conf.lmp exist in the current dir
+    # conf_file and graph_file are linked into task_path relative to it
     assert(os.path.isfile(conf_file))
     assert(os.path.isfile(graph_file))
-    conf_file = os.path.abspath(conf_file)
-    graph_file = os.path.abspath(graph_file)
     model_mass_map = jdata['model_mass_map']
     # MD simulation protocol
     nsteps = jdata['nsteps']
@@ -65,11 +179,9 @@ def _make_tasks_onephase(temp,
     tau_t = jdata['tau_t']
     tau_p = jdata['tau_p']
 
-    cwd = os.getcwd()
     create_path(task_path)
-    os.chdir(task_path)
-    os.symlink(os.path.relpath(conf_file), 'conf.lmp')
-    os.symlink(os.path.relpath(graph_file), 'graph.pb')
+    os.symlink(os.path.relpath(conf_file, task_path), os.path.join(task_path, 'conf.lmp'))
+    os.symlink(os.path.relpath(graph_file, task_path), os.path.join(task_path, 'graph.pb'))
     
     # input for NPT MD
     lmp_str \
@@ -84,12 +196,10 @@ def _make_tasks_onephase(temp,
                                tau_t = tau_t,
                                tau_p = tau_p,
                                prt_freq = stat_freq)
-    with open('thermo.out', 'w') as fp :
+    with open(os.path.join(task_path, 'thermo.out'), 'w') as fp :
         fp.write('%.16e %.16e' % (temp, pres))
-    with open('in.lammps', 'w') as fp :
+    with open(os.path.join(task_path, 'in.lammps'), 'w') as fp :
         fp.write(lmp_str)
-
-    os.chdir(cwd)
     # end _make_tasks_onephase
 
 
@@ -110,10 +220,13 @@ def _setup_dpdt (task_path, jdata) :
     # conf_1_name = 'conf.%s.lmp' % name_1
     copied_conf_0 = os.path.join(os.path.abspath(task_path), conf_0_name)
     copied_conf_1 = os.path.join(os.path.abspath(task_path), conf_1_name)
-    shutil.copyfile(conf_0, copied_conf_0)
-    shutil.copyfile(conf_1, copied_conf_1)
+    with ThreadPoolExecutor(max_workers = 2) as executor :
+        list(executor.map(shutil.copyfile, [conf_0, conf_1], [copied_conf_0, copied_conf_1]))
     linked_model = os.path.join(os.path.abspath(task_path), 'graph.pb')
-    shutil.copyfile(model, linked_model)
+    # the model is never modified, link it instead of copying
+    if os.path.lexists(linked_model) :
+        os.unlink(linked_model)
+    os.symlink(model, linked_model)
 
     with open(os.path.join(os.path.abspath(task_path), 'in.json'), 'w') as fp:
         json.dump(jdata, fp, indent=4)
@@ -123,19 +236,23 @@ def make_dpdt (temp,
                pres,
                inte_dir,
                task_path,
+               jdata,
                mdata,
                ssh_sess,
                natoms = None,
                verbose = False) :
     assert(os.path.isdir(task_path))    
-
-    cwd = os.getcwd()
-    os.chdir(task_path)
+    db_path = os.path.join(task_path, 'database')
+    dpdt_file = os.path.join(db_path, 'dpdt.out')
 
     # check if we need new MD simulations
     new_task = True
-    if (not os.path.isdir('database')) or \
-       (not os.path.isfile('database/dpdt.out')):
+    try :
+        data, index = _load_dpdt(dpdt_file)
+    except FileNotFoundError :
+        data = None
+    if data is None or data.shape[0] == 0 :
+        data = None
         if verbose :
             print('# dpdt: cannot find any MD record, start from scrtach')
         new_task = True
@@ -143,98 +260,87 @@ def make_dpdt (temp,
     else :
         if verbose :
             print('# dpdt: found MD records, search if any record matches')
-        data = np.loadtxt('database/dpdt.out')
-        data = np.reshape(data, [-1,4])
         counter = data.shape[0]
-        for ii in range(data.shape[0]) :
-            if (np.linalg.norm(temp - data[ii][0]) < 1e-4) and \
-               (np.linalg.norm(pres - data[ii][1]) < 1e-2) :
-                if verbose :
-                    print('# dpdt: found matched record at %f %f ' % (temp, pres))
-                new_task = False
-                dv = data[ii][2]
-                dh = data[ii][3]
-                break
+        matched = np.flatnonzero((np.abs(data[:,0] - temp) < 1e-4) & \
+                                 (np.abs(data[:,1] - pres) < 1e-2))
+        if matched.size > 0 :
+            ii = matched[0]
+            if verbose :
+                print('# dpdt: found matched record at %f %f ' % (temp, pres))
+            new_task = False
+            dv = data[ii][2]
+            dh = data[ii][3]
 
     # try to find nearest simulation
-    if new_task and os.path.isfile('database/dpdt.out'):
-        data = np.loadtxt('database/dpdt.out')
-        data = np.reshape(data, [-1,4])
-        min_idx = -1
-        min_val = 1e10
+    if new_task and data is not None :
         if inte_dir == 't' :
-            for ii in range(data.shape[0]) :
-                dist = np.abs(data[ii][0] - temp)
-                if dist < min_val :
-                    min_val = dist
-                    min_idx = ii
+            min_idx = _nearest_record(index[0][0], index[0][1], temp)
         elif inte_dir == 'p' :
-            for ii in range(data.shape[0]) :
-                dist = np.abs(data[ii][1] - pres)
-                if dist < min_val :
-                    min_val = dist
-                    min_idx = ii
+            min_idx = _nearest_record(index[1][0], index[1][1], pres)
         else :
             raise RuntimeError("invalid inte_dir " + inte_dir)
-        assert(min_idx >= 0)
-        conf_0 = os.path.join('database', 'task.%06d' % min_idx, '0', 'out.lmp')
-        conf_1 = os.path.join('database', 'task.%06d' % min_idx, '1', 'out.lmp')
+        conf_0 = os.path.join(db_path, 'task.%06d' % min_idx, '0', 'out.lmp')
+        conf_1 = os.path.join(db_path, 'task.%06d' % min_idx, '1', 'out.lmp')
     else :
-        conf_0 = 'conf.0.lmp'
-        conf_1 = 'conf.1.lmp'
+        conf_0 = os.path.join(task_path, 'conf.0.lmp')
+        conf_1 = os.path.join(task_path, 'conf.1.lmp')
 
     # new MD simulations are needed
     if new_task :
         if verbose :
             print('# dpdt: do not find any matched record, run new task from %d ' % counter)
-        jdata = json.load(open('in.json', 'r'))        
         # make new task
-        work_path = os.path.join('database', 'task.%06d' % counter)
+        work_path = os.path.join(db_path, 'task.%06d' % counter)
         _make_tasks_onephase(temp, pres, 
                              os.path.join(work_path, '0'),
                              jdata, 
                              conf_file = conf_0,
-                             graph_file = 'graph.pb')
+                             graph_file = os.path.join(task_path, 'graph.pb'))
         _make_tasks_onephase(temp, pres, 
                              os.path.join(work_path, '1'),
                              jdata, 
                              conf_file = conf_1,
-                             graph_file = 'graph.pb')
+                             graph_file = os.path.join(task_path, 'graph.pb'))
         # submit new task
         resources = mdata['resources']
         lmp_exec = mdata['lmp_command']
         command = lmp_exec + " -i in.lammps > /dev/null"
-        forward_files = ['conf.lmp', 'in.lammps', 'graph.pb']
+        forward_common_files = [os.path.abspath(os.path.join(task_path, 'graph.pb'))]
+        forward_files = ['conf.lmp', 'in.lammps']
         backward_files = ['log.lammps', 'out.lmp']
         run_tasks = ['0', '1']        
+        # one job per phase: the tasks of a job run one after another,
+        # separate jobs are all submitted before the first poll and overlap.
+        # graph.pb is staged once per ssh session, not once per job
         _group_slurm_jobs(ssh_sess,
                           resources,
                           command,
                           work_path,
                           run_tasks,
                           1,
-                          [],
+                          forward_common_files,
                           forward_files,
                           backward_files)
         # collect resutls
         log_0 = os.path.join(work_path, '0', 'log.lammps')
         log_1 = os.path.join(work_path, '1', 'log.lammps')
         if natoms == None :
-            natoms = [get_natoms('conf.0.lmp'), get_natoms('conf.1.lmp')]
+            natoms = [get_natoms(os.path.join(task_path, 'conf.0.lmp')),
+                      get_natoms(os.path.join(task_path, 'conf.1.lmp'))]
         stat_skip = jdata['stat_skip']
         stat_bsize = jdata['stat_bsize']
         t0 = ti._compute_thermo(log_0, natoms[0], stat_skip, stat_bsize)
         t1 = ti._compute_thermo(log_1, natoms[1], stat_skip, stat_bsize)
         dv = t1['v'] - t0['v']
         dh = t1['h'] - t0['h']
-        with open(os.path.join('database', 'dpdt.out'), 'a') as fp:
-            fp.write('%.16e %.16e %.16e %.16e\n' % \
-                     (temp, pres, dv, dh))            
-    os.chdir(cwd)
+        _append_dpdt(dpdt_file, temp, pres, dv, dh)
     return [dv, dh]
 
 
 class GibbsDuhemFunc (object):
+    __slots__ = ('jdata', 'mdata', 'task_path', 'inte_dir', 'natoms', 'verbose', 'pref',
+                 'ssh_sess', 'ev2bar', '_cache')
+
     def __init__ (self,
                   jdata,
                   mdata,
@@ -250,28 +356,41 @@ class GibbsDuhemFunc (object):
         self.natoms = natoms
         self.verbose =  verbose
         self.pref = pref
+        # (temp, pres) rounded to the matching tolerance of make_dpdt -> [dv, dh]
+        self._cache = {}
         
         self.ssh_sess = SSHSession(mdata['machine'])
         if os.path.isdir(task_path) :
             print('find path ' + task_path + ' use it. The user should guarantee the consistency between the jdata and the found work path ')
         else :
             _setup_dpdt(task_path, jdata)
+        # the configurations are fixed during the integration
+        if self.natoms is None :
+            with ThreadPoolExecutor(max_workers = 2) as executor :
+                self.natoms = list(executor.map(get_natoms,
+                                                [os.path.join(task_path, 'conf.0.lmp'),
+                                                 os.path.join(task_path, 'conf.1.lmp')]))
 
         self.ev2bar = pc.electron_volt / (pc.angstrom ** 3) * 1e-5
 
+    def _dpdt (self, temp, pres) :
+        # solve_ivp hands y over as a 1-element array
+        key = (round(np.asarray(temp).item(), 4), round(np.asarray(pres).item(), 2))
+        if key not in self._cache :
+            self._cache[key] = make_dpdt(temp, pres,
+                                         self.inte_dir,
+                                         self.task_path, self.jdata, self.mdata, self.ssh_sess, self.natoms, self.verbose)
+        return self._cache[key]
+
     def __call__ (self, x, y) :
         if self.inte_dir == 't' :
             # x: temp, y: pres
-            [dv, dh] = make_dpdt(x, y,
-                                 self.inte_dir,
-                                 self.task_path, self.mdata, self.ssh_sess, self.natoms, self.verbose)
-            return [dh / (x * dv) * self.ev2bar * self.pref]
+            [dv, dh] = self._dpdt(x, y)
+            return np.array([dh / (x * dv) * self.ev2bar * self.pref])
         elif self.inte_dir == 'p' :
             # x: pres, y: temp
-            [dv, dh] = make_dpdt(y, x,
-                                 self.inte_dir,
-                                 self.task_path, self.mdata, self.ssh_sess, self.natoms, self.verbose)
-            return [(y * dv) / dh / self.ev2bar * (1/self.pref)]
+            [dv, dh] = self._dpdt(y, x)
+            return np.array([(y * dv) / dh / self.ev2bar * (1/self.pref)])
 
 
 def _main () :
@@ -303,13 +422,16 @@ def _main () :
                         help='print detailed infomation')
     args = parser.parse_args()
     
-    jdata = json.load(open(args.PARAM))
-    mdata = json.load(open(args.MACHINE))
+    with open(args.PARAM) as fp :
+        jdata = json.load(fp)
+    with open(args.MACHINE) as fp :
+        mdata = json.load(fp)
     natoms = None
     if args.water :
         conf_0 = jdata['phase_i']['equi_conf']
         conf_1 = jdata['phase_ii']['equi_conf']
-        natoms = [get_natoms(conf_0), get_natoms(conf_1)]
+        with ThreadPoolExecutor(max_workers = 2) as executor :
+            natoms = list(executor.map(get_natoms, [conf_0, conf_1]))
         natoms = [ii // 3  for ii in natoms]
     print (natoms)
         
@@ -46,6 +46,10 @@ class SSHSession (object) :
         self.remote_uname = self.remote_profile['username']
         self.remote_workpath = self.remote_profile['work_path']
         self.ssh = self._setup_ssh(self.remote_host, self.remote_port, username = self.remote_uname)
+        # one sftp channel shared by all jobs of the session
+        self.sftp = self.ssh.open_sftp()
+        # remote paths of the files staged by stage_file
+        self.staged_files = set()
         
     def _setup_ssh(self,
                    hostname,
@@ -57,15 +61,45 @@ class SSHSession (object) :
         ssh_client.set_missing_host_key_policy(paramiko.WarningPolicy)
         ssh_client.connect(hostname, port=port, username=username, password=password)
         assert(ssh_client.get_transport().is_active())
+        ssh_client.get_transport().set_keepalive(30)
         return ssh_client
 
     def get_ssh_client(self) :
         return self.ssh
 
+    def get_sftp(self) :
+        return self.sftp
+
+    def stage_file(self, local_file) :
+        """
+        Upload local_file once to the common dir of the session root and
+        return the remote path. The staged copy is keyed by the name, size
+        and mtime of the file, so an unchanged file is never sent again.
+        """
+        st = os.stat(local_file)
+        remote_dir = os.path.join(self.remote_workpath, 'common')
+        remote_file = os.path.join(remote_dir, '%s.%d.%d' % (os.path.basename(local_file), st.st_size, st.st_mtime_ns))
+        if remote_file in self.staged_files :
+            return remote_file
+        try :
+            self.sftp.stat(remote_file)
+        except IOError :
+            try :
+                self.sftp.stat(remote_dir)
+            except IOError :
+                self.sftp.mkdir(remote_dir)
+            # upload under a temporary name, so a partial copy is never used
+            tmp_file = remote_file + '.' + str(uuid.uuid4())
+            self.sftp.put(local_file, tmp_file)
+            self.sftp.posix_rename(tmp_file, remote_file)
+        self.staged_files.add(remote_file)
+        return remote_file
+
     def get_session_root(self) :
         return self.remote_workpath
 
     def close(self) :
+        self.sftp.close()
         self.ssh.close()
 
 
@@ -82,9 +116,8 @@ class RemoteJob (object):
         print("local_root is ", local_root)
         print("remote_root is", self.remote_root)
         self.ssh = ssh_session.get_ssh_client()        
-        sftp = self.ssh.open_sftp()        
-        sftp.mkdir(self.remote_root)
-        sftp.close()
+        self.sftp = ssh_session.get_sftp()
+        self.sftp.mkdir(self.remote_root)
         # open('job_uuid', 'w').write(self.job_uuid)
         
     def get_job_root(self) :
@@ -115,6 +148,34 @@ class RemoteJob (object):
         self._get_files(file_list)
         os.chdir(cwd)
         
+    def upload_bulk(self,
+                    job_dirs,
+                    local_up_files,
+                    linked_files = {},
+                    dereference = True) :
+        """
+        linked_files maps a file name to a remote path (e.g. from
+        SSHSession.stage_file), it is linked into each of the job_dirs.
+        """
+        file_list = []
+        for ii in job_dirs :
+            for jj in local_up_files :
+                file_list.append(os.path.join(ii,jj))
+        link_cmd = []
+        for ii in job_dirs :
+            for name, remote_file in linked_files.items() :
+                link_cmd.append('ln -sf %s %s' % (remote_file, os.path.join(ii, name)))
+        self._put_files_stream(file_list, post_cmd = ' && '.join(link_cmd), dereference = dereference)
+
+    def download_bulk(self,
+                      job_dirs,
+                      remote_down_files) :
+        file_list = []
+        for ii in job_dirs :
+            for jj in remote_down_files :
+                file_list.append(os.path.join(ii,jj))
+        self._get_files_stream(file_list)
+
     def block_checkcall(self, 
                         cmd) :
         stdin, stdout, stderr = self.ssh.exec_command(('cd %s ;' % self.remote_root) + cmd)
@@ -130,9 +191,8 @@ class RemoteJob (object):
         return exit_status, stdin, stdout, stderr
 
     def clean(self) :        
-        sftp = self.ssh.open_sftp()        
+        sftp = self.sftp
         self._rmtree(sftp, self.remote_root)
-        sftp.close()
 
     def _rmtree(self, sftp, remotepath, level=0, verbose = False):
         for f in sftp.listdir_attr(remotepath):
@@ -162,14 +222,13 @@ class RemoteJob (object):
         # trans
         from_f = os.path.join(self.local_root, of)
         to_f = os.path.join(self.remote_root, of)
-        sftp = self.ssh.open_sftp()
+        sftp = self.sftp
         sftp.put(from_f, to_f)
         # remote extract
         self.block_checkcall('tar xf %s' % of)
         # clean up
         os.remove(from_f)
         sftp.remove(to_f)
-        sftp.close()
 
     def _get_files(self, 
                    files) :
@@ -184,7 +243,7 @@ class RemoteJob (object):
         to_f = os.path.join(self.local_root, of)
         if os.path.isfile(to_f) :
             os.remove(to_f)
-        sftp = self.ssh.open_sftp()
+        sftp = self.sftp
         sftp.get(from_f, to_f)
         # extract
         cwd = os.getcwd()
@@ -196,6 +255,33 @@ class RemoteJob (object):
         os.remove(to_f)
         sftp.remove(from_f)
 
+    def _put_files_stream(self,
+                          files,
+                          post_cmd = '',
+                          dereference = True) :
+        # pipe an uncompressed tar stream into the remote tar,
+        # no archive is written on either side
+        cmd = 'cd %s; tar xf -' % self.remote_root
+        if len(post_cmd) > 0 :
+            cmd += ' && ' + post_cmd
+        stdin, stdout, stderr = self.ssh.exec_command(cmd)
+        with tarfile.open(fileobj = stdin, mode = "w|", dereference = dereference) as tar:
+            for ii in files :
+                tar.add(os.path.join(self.local_root, ii), arcname = ii)
+        stdin.channel.shutdown_write()
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            raise RuntimeError("Get error code %d in uploading files through ssh with job: %s " % (exit_status, self.job_uuid))
+
+    def _get_files_stream(self,
+                          files) :
+        stdin, stdout, stderr = self.ssh.exec_command('cd %s; tar cf - %s' % (self.remote_root, ' '.join(files)))
+        with tarfile.open(fileobj = stdout, mode = "r|") as tar:
+            tar.extractall(path = self.local_root)
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            raise RuntimeError("Get error code %d in downloading files through ssh with job: %s " % (exit_status, self.job_uuid))
+
 class CloudMachineJob (RemoteJob) :
     def submit(self, 
                job_dirs,
@@ -245,7 +331,7 @@ class CloudMachineJob (RemoteJob) :
             for ii in job_dirs:
                 args.append('')
         script = os.path.join(self.remote_root, script_name)
-        sftp = self.ssh.open_sftp()
+        sftp = self.sftp
         with sftp.open(script, 'w') as fp :
             fp.write('#!/bin/bash\n\n')
             # fp.write('set -euo pipefail\n')
@@ -273,7 +359,6 @@ class CloudMachineJob (RemoteJob) :
                 fp.write('cd %s\n' % self.remote_root)         
                 fp.write('test $? -ne 0 && exit\n')  
             fp.write('\ntouch tag_finished\n')
-        sftp.close()
         return script_name
 
 
@@ -287,10 +372,10 @@ class SlurmJob (RemoteJob) :
         stdin, stdout, stderr = self.block_checkcall(('cd %s; sbatch %s' % (self.remote_root, script_name)))
         subret = (stdout.readlines())
         job_id = subret[0].split()[-1]
-        sftp = self.ssh.open_sftp()
+        sftp = self.sftp
         with sftp.open(os.path.join(self.remote_root, 'job_id'), 'w') as fp:
             fp.write(job_id)
-        sftp.close()
+        self.job_id = job_id
 
     def check_status(self) :
         job_id = self._get_job_id()
@@ -310,6 +395,44 @@ class SlurmJob (RemoteJob) :
                     ("status command squeue fails to execute\nerror message:%s\nreturn code %d\n" % (err_str, ret))
         status_line = stdout.read().decode('utf-8').split ('\n')[-2]
         status_word = status_line.split ()[-4]
+        return self._status_from_word(status_word)
+
+    @classmethod
+    def check_status_batch(cls, ssh_sess, jobs) :
+        """
+        Check the status of all jobs with a single squeue call.
+        Returns a dict: job_id -> JobStatus
+        """
+        job_ids = [ii._get_job_id() for ii in jobs]
+        for ii,jj in zip(jobs, job_ids) :
+            if jj == "" :
+                raise RuntimeError("job %s is has not been submitted" % ii.remote_root)
+        stdin, stdout, stderr \
+            = ssh_sess.get_ssh_client().exec_command("squeue -h -o '%%i %%t' --jobs=%s" % ','.join(job_ids))
+        ret = stdout.channel.recv_exit_status()
+        out_str = stdout.read().decode('utf-8')
+        err_str = stderr.read().decode('utf-8')
+        if (ret != 0) and (str("Invalid job id specified") not in err_str) :
+            raise RuntimeError\
+                ("status command squeue fails to execute\nerror message:%s\nreturn code %d\n" % (err_str, ret))
+        status_words = {}
+        if ret == 0 :
+            for line in out_str.split('\n') :
+                words = line.split()
+                if len(words) == 2 :
+                    status_words[words[0]] = words[1]
+        status = {}
+        for ii,jj in zip(jobs, job_ids) :
+            if jj in status_words :
+                status[jj] = ii._status_from_word(status_words[jj])
+            # jobs that left the queue
+            elif ii._check_finish_tag() :
+                status[jj] = JobStatus.finished
+            else :
+                status[jj] = JobStatus.terminated
+        return status
+
+    def _status_from_word(self, status_word) :
         if      status_word in ["PD","CF","S"] :
             return JobStatus.waiting
         elif    status_word in ["R","CG"] :
@@ -323,20 +446,20 @@ class SlurmJob (RemoteJob) :
             return JobStatus.unknown
     
     def _get_job_id(self) :
-        sftp = self.ssh.open_sftp()
+        if getattr(self, 'job_id', None) is not None :
+            return self.job_id
+        sftp = self.sftp
         with sftp.open(os.path.join(self.remote_root, 'job_id'), 'r') as fp:            
             ret = fp.read().decode('utf-8')
-        sftp.close()
         return ret
 
     def _check_finish_tag(self) :
-        sftp = self.ssh.open_sftp()
+        sftp = self.sftp
         try:
             sftp.stat(os.path.join(self.remote_root, 'tag_finished')) 
             ret =  True
         except IOError:
             ret = False
-        sftp.close()
         return ret
 
     def _make_script(self, 
@@ -400,10 +523,9 @@ class SlurmJob (RemoteJob) :
 
         script_name = 'run.sub'
         script = os.path.join(self.remote_root, script_name)
-        sftp = self.ssh.open_sftp()
+        sftp = self.sftp
         with sftp.open(script, 'w') as fp :
             fp.write(ret)
-        sftp.close()
 
         return script_name
 
@@ -418,10 +540,9 @@ class PBSJob (RemoteJob) :
         stdin, stdout, stderr = self.block_checkcall(('cd %s; qsub %s' % (self.remote_root, script_name)))
         subret = (stdout.readlines())
         job_id = subret[0].split()[0]
-        sftp = self.ssh.open_sftp()
+        sftp = self.sftp
         with sftp.open(os.path.join(self.remote_root, 'job_id'), 'w') as fp:
             fp.write(job_id)
-        sftp.close()
 
     def check_status(self) :
         job_id = self._get_job_id()
@@ -455,20 +576,18 @@ class PBSJob (RemoteJob) :
             return JobStatus.unknown
     
     def _get_job_id(self) :
-        sftp = self.ssh.open_sftp()
+        sftp = self.sftp
         with sftp.open(os.path.join(self.remote_root, 'job_id'), 'r') as fp:
             ret = fp.read().decode('utf-8')
-        sftp.close()
         return ret
 
     def _check_finish_tag(self) :
-        sftp = self.ssh.open_sftp()
+        sftp = self.sftp
         try:
             sftp.stat(os.path.join(self.remote_root, 'tag_finished')) 
             ret =  True
         except IOError:
             ret = False
-        sftp.close()
         return ret
 
     def _make_script(self, 
@@ -523,10 +642,9 @@ class PBSJob (RemoteJob) :
 
         script_name = 'run.sub'
         script = os.path.join(self.remote_root, script_name)
-        sftp = self.ssh.open_sftp()
+        sftp = self.sftp
         with sftp.open(script, 'w') as fp :
             fp.write(ret)
-        sftp.close()
 
         return script_name
 
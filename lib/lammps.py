@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import mmap
 import numpy as np
 
 def get_natoms(filename) :
@@ -25,20 +26,45 @@ def _is_n_number(inputs, nn) :
 
 def get_thermo(filename) :
     # print('~~~',filename)
-    with open(filename, 'r') as fp :
-        fc = fp.read().split('\n')
-    for sl in range(len(fc)) :
-        if 'Step KinEng PotEng TotEng' in fc[sl] :
-            break
-    nwords = len(fc[sl+1].split())
-    data = []
-    for el in range(sl+1,len(fc)) :
-        flag, res = _is_n_number(fc[el], nwords) 
-        if not flag:
-            break
-        else :
-            data.append(res)
-    data = np.array(data)
+    with open(filename, 'rb') as fp :
+        with mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ) as mm :
+            head = mm.find(b'Step KinEng PotEng TotEng')
+            if head < 0 :
+                raise RuntimeError("cannot find thermo header in " + filename)
+            sl = mm.find(b'\n', head)
+            if sl < 0 :
+                return np.array([])
+            sl += 1
+            # the thermo block ends at the first line with a different number of words
+            nwords = None
+            nrows = 0
+            pos = sl
+            while pos < len(mm) :
+                el = mm.find(b'\n', pos)
+                if el < 0 :
+                    el = len(mm)
+                words = len(mm[pos:el].split())
+                if nwords is None :
+                    nwords = words
+                if words != nwords or words == 0 :
+                    break
+                nrows += 1
+                pos = el + 1
+        if nrows == 0 :
+            return np.array([])
+        fp.seek(sl)
+        try :
+            data = np.loadtxt(fp, comments = None, max_rows = nrows, ndmin = 2)
+        except ValueError :
+            # a row holds a word that is not a number, stop the block there
+            fp.seek(sl)
+            data = []
+            for ii in range(nrows) :
+                flag, res = _is_n_number(fp.readline().decode(), nwords)
+                if not flag :
+                    break
+                data.append(res)
+            data = np.array(data)
     return data
 
 def get_thermo_old(filename) :
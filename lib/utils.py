@@ -34,21 +34,11 @@ def copy_file_list (file_list, from_path, to_path) :
 
 
 def block_avg(inp, skip = 0, block_size = 10) :
-    inp = inp[skip:]
-    data_chunks = [
-        [j for j in inp[i:i+block_size]] \
-        for i in range(0, len(inp), block_size)
-    ]
-    nblocks = len(data_chunks)
-    if (len(data_chunks[-1]) != block_size) :
-        nblocks -= 1
-        data_chunks = data_chunks[:nblocks]
-    assert (len(data_chunks) == nblocks)
-    # naive avg
-    naive_avg = np.average(inp)
-    naive_err = np.std(inp) / np.sqrt(len(inp) - 1)
+    inp = np.asarray(inp)[skip:]
+    # incomplete trailing block is dropped
+    nblocks = len(inp) // block_size
+    data_chunks = np.reshape(inp[:nblocks * block_size], [nblocks, block_size])
     # block avg
-    data_chunks = np.array(data_chunks)
     data_block = np.average(data_chunks, axis = 1)
     block_avg = np.average(data_block)
     if len(data_block) != 1 :